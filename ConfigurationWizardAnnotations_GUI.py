@@ -3,12 +3,19 @@
 import os
 import sys
 import time
+launchClock = time.perf_counter()	# 启动计时起点
 import re
-import PySide6
+import json
+import codecs
+import hashlib
+import inspect
+import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
 from PySide6 import QtCore, QtGui, QtWidgets
-from PySide6.QtCore import Qt, QModelIndex, Signal
-from PySide6.QtGui import QStandardItemModel, QStandardItem, QAction, QGuiApplication,QValidator
-from PySide6.QtWidgets import QApplication,QErrorMessage,QItemDelegate,QMainWindow,QVBoxLayout,QWidget,QAbstractItemView,QHeaderView,QStyleFactory,QMessageBox
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QAction, QGuiApplication,QValidator
+from PySide6.QtWidgets import QApplication,QMainWindow,QVBoxLayout,QWidget
 
 # 👌 已支持的语法列表
 tokenSpecification = [
@@ -21,7 +28,7 @@ tokenSpecification = [
 	("NOTIFICATION", r"<n>"),           # n: 文本信息(创建叶节点)
 	("HELPINFO", r"<i>"),               # i: 帮助信息(不占用节点，附加到前一个节点上)
 	("STRING", r"<s>"),                 # s: 帮助信息(不占用节点，附加到前一个节点上)
-	("FLAG", r"<q>"),                   # q: 标志位复选框(创建叶节点) 			## 实际效果等价于没有子节点的 e 
+	("FLAG", r"<q[.0-9]*>"),            # q: 标志位复选框(创建叶节点) 			## 实际效果等价于没有子节点的 e 
 	("SYMBOL_NUMBER", r"<y>"),          # y: 符号或数字(创建叶节点)
 	("DEFAULT", r"<d>"),                # d: 默认配置
 	("ESCAPE", r"</[hec]>"),            # 退出节点
@@ -33,11 +40,70 @@ tokenSpecification = [
 	("REGIONEND", r"<<< end of configuration section >>>")
 ]
 
-styleSheet = ""
+themePalette = {}	# 主题配色 {QPalette.ColorRole 名称: 颜色}, 如 {"Window": "#404040"}, 为空时使用系统配色
 userFont = "0xProto Nerd Font"
 SafeMode = 1	# 安全模式下会将原文件备份，否则直接删除
+fallbackEncoding = "gbk"	# 文件不是 UTF-8 编码时使用的编码
+startupTiming = 0	# 启动后输出窗口显示与可交互耗时
 passinaFile = None
 # passinaFile = r"//wsl.localhost/DevLinux/home/reglucis/project/YueShell/Sys/FileSystem/FatFs/fatfs_conf.h"
+# 宏定义寄存器模型: 绑定到同一个 define 的位域选项共享一个值
+# 位域按解析时预先计算的 mask/shift 提取与写入, 写回时保持原有的进制、位宽、大小写和 U/L 后缀
+class DefineRegister:
+	numberFormat = re.compile(r"(0[xX])([0-9a-fA-F]+)([uUlL]*)|([0-9]+)([uUlL]*)")
+
+	def __init__(self, name, text, line):
+		self.name = name
+		self.line = line
+		self.nodes = []
+		self.setText(text)
+
+	def setText(self, text):
+		self.text = str(text)
+		self.value = None		# 非整数宏值(字符串、符号、浮点数)时为 None
+		match = DefineRegister.numberFormat.fullmatch(self.text.strip())
+		if match is None:
+			return
+		if match.group(1) is not None:
+			self.base = 16
+			self.prefix = match.group(1)
+			self.width = len(match.group(2))
+			self.upper = any(c in "ABCDEF" for c in match.group(2))
+			self.suffix = match.group(3)
+		else:
+			self.base = 8 if len(match.group(4)) > 1 and match.group(4)[0] == "0" else 10
+			self.prefix = ""
+			self.width = 0
+			self.upper = False
+			self.suffix = match.group(5)
+		self.value = parseNumber(self.text)
+
+	def format(self, value:int):
+		if self.base == 16:
+			digits = f"{value:0{self.width}X}" if self.upper else f"{value:0{self.width}x}"
+		elif self.base == 8:
+			digits = f"0{value:o}"
+		else:
+			digits = str(value)
+		return f"{self.prefix}{digits}{self.suffix}"
+
+	def setNumber(self, value:int):
+		if value < 0 and self.base != 10:
+			raise RuntimeError(f"{self.name}: 十六进制/八进制宏值不能为负数 {value}")
+		self.value = value
+		self.text = self.format(value)
+
+	def getField(self, node):
+		if node.mask == 0:
+			return self.value
+		return (self.value & node.mask) >> node.shift
+
+	def setField(self, node, field:int):
+		if node.mask == 0:
+			self.setNumber(field)
+		else:
+			self.setNumber((self.value & ~node.mask) | ((field << node.shift) & node.mask))
+
 # WizardAnnotations 节点类
 class ConfigurationNode:
 	def __init__(self, identifier = None, lastNode = None):
@@ -48,14 +114,23 @@ class ConfigurationNode:
 		self.childNodeTree = []
 		self.TreeViewItem = None
 		self.skipItem = 0
+
+		# 使能依赖 (由 ConfigurationWizard 在解析后建立)
+		self.enableGate = None		# 最近的外层 <e>/<c> 分组
+		self.gatedNodes = []		# 以本节点为 enableGate 的节点
+		self.enable = True			# 有效使能状态: 所有外层分组均已使能
 		self.default = None
 
 		# 匹配的 define
+		self.register = None		# 绑定后 bindingDefineValue 读写该 DefineRegister
 		self.bindingDefineName = None
 		self.bindingDefineValue = None
+		self.defineLine = None		# define 所在行号(从 1 开始)
+		self.skipDefine = 0			# <on> 跳过之后的 n 个 define
 		
-		# 适用于 <?.x> mask 只允许设置一位，即 (1 << k)
+		# 适用于 <?.x> <?.x..y>, shift 为 mask 最低位, 在绑定 define 时计算
 		self.mask = 0
+		self.shift = 0
 
 		# 定义：step 用于判断 bindingDefineValue 值类型
 		# 定义：不指定 step 时, 默认为 int(1)
@@ -63,6 +138,11 @@ class ConfigurationNode:
 		self.upperLimit = None
 		self.lowerLimit = None
 		self.step = None
+		# <#+-*/k> 显示值经修饰后得到实际值, 如 "/4"
+		self.modifier = None
+
+		# 子树哈希 (结构 + 绑定值), 由 ConfigurationWizard.hashTree 计算
+		self.subtreeHash = None
 
 		# 复选框 c
 		self.check = None
@@ -73,6 +153,41 @@ class ConfigurationNode:
 		self.comboListName = []
 		self.comboListValue = []
 
+	@property
+	def bindingDefineValue(self):
+		return self.register.text if self.register is not None else self._bindingDefineValue
+
+	@bindingDefineValue.setter
+	def bindingDefineValue(self, value):
+		if self.register is not None:
+			self.register.setText(value)
+		else:
+			self._bindingDefineValue = value
+
+	# 选项值: 位域选项为对应位段的值, 其余为整个宏值
+	def getValue(self):
+		if self.register is not None and self.register.value is not None and self.mask != 0:
+			return str(self.register.getField(self))
+		return self.bindingDefineValue
+
+	# 整数按原有格式写入(位域选项只改写对应位段), 其余按文本写入
+	def setValue(self, value):
+		if self.register is None:
+			self.bindingDefineValue = value
+			return
+		number = value if isinstance(value, int) else parseNumber(value)
+		if self.register.value is not None and isinstance(number, int):
+			self.register.setField(self, number)
+		else:
+			self.register.setText(value)
+
+	# 复选框: 置位或清零本节点的位段
+	def setSwitch(self, on:bool):
+		if self.register is not None and self.register.value is not None and self.mask != 0:
+			self.register.setField(self, (self.mask >> self.shift) if on else 0)
+		else:
+			self.bindingDefineValue = 1 if on else 0
+
 	def addChild(self, node):
 		self.childNodeTree.append(node)
 
@@ -85,295 +200,956 @@ class ConfigurationNode:
 	def bindTreeViewItem(self, item):
 		self.TreeViewItem = item
 
+	# 由各级标题描述组成的节点路径, 如 "Thread Configuration/Number of concurrent running threads"
+	def path(self):
+		names = []
+		node = self
+		while node is not None and node.identifier != "R":
+			names.append(str(node.description).strip())
+			node = node.lastNode
+		return "/".join(reversed(names))
+
+	# <e>/<c> 分组自身的开关状态 (<e.n> 只看第 n 位)
+	def isSwitchOn(self):
+		value = self.register.value if self.register is not None else self.bindingDefineValue
+		if isinstance(value, str):
+			value = parseNumber(value)
+		if value is None:
+			return True
+		return (int(value) & self.mask) != 0 if self.mask != 0 else value != 0
+
+	# 按选项类型转换后的值: 复选框为 bool, 数字为 int/float, 其余为 str
+	def typedValue(self):
+		if self.identifier in ("e", "c", "q") or (self.mask != 0 and self.mask & (self.mask - 1) == 0 and len(self.comboListValue) == 0):
+			return self.isSwitchOn()
+		value = self.getValue()
+		if self.identifier == "o":
+			number = parseNumber(value)
+			if number is not None:
+				return number
+		return value if value is None else str(value)
+
+	# 分组开关变化后, 只更新有效使能状态发生改变的后代, 返回这些节点
+	def propagateEnable(self):
+		changed = []
+		stack = [self]
+		while stack:
+			gate = stack.pop()
+			state = gate.enable and gate.isSwitchOn()
+			for node in gate.gatedNodes:
+				if node.enable != state:
+					node.enable = state
+					changed.append(node)
+					if len(node.gatedNodes) != 0:
+						stack.append(node)
+		return changed
+
 class ConfigurationListItem:
-	def __init__(self, identifier, defineName = None, defineValue = None):
+	def __init__(self, identifier, defineName = None, defineValue = None, defineLine = None, node:ConfigurationNode = None):
 		self.identifier  = identifier
 		self.targetName  = defineName
 		self.targetValue = defineValue
+		self.targetLine  = defineLine
+		# 选项类型信息
+		self.description = None if node is None else node.description
+		self.lowerLimit  = None if node is None else node.lowerLimit
+		self.upperLimit  = None if node is None else node.upperLimit
+		self.step        = None if node is None else node.step
+		self.mask        = 0 if node is None else node.mask
+		self.fieldValue  = None if node is None else node.typedValue()
 	
+# 将 C 数字字面量(允许 U/L 后缀)转换为 int 或 float, 无法转换时返回 None
+def parseNumber(text:str):
+	text = str(text).strip().rstrip("uUlL")
+	try:
+		if "." in text:
+			return float(text)
+		if len(text) > 1 and text[0] == "0" and text[1] not in "xXbB":
+			return int(text, 8)
+		return int(text, 0)
+	except ValueError:
+		return None
+
+# 比较用的宏值: 数字按数值比较(0x10 与 16 相同), 其余按文本比较
+def normalizeValue(value):
+	number = parseNumber(value)
+	return str(value).strip() if number is None else number
+
+# 配置树遍历: 显式栈 + 生成器, 不递归也不共享可变状态, 深层嵌套的头文件与多线程下均可使用
+# prune(node) 为 True 时仍产出该节点, 但跳过其子树
+# 先序: 父节点先于子节点, 兄弟节点按文件顺序
+def walkTree(root:ConfigurationNode, prune = None):
+	stack = [root]
+	while stack:
+		node = stack.pop()
+		yield node
+		if prune is None or not prune(node):
+			stack.extend(reversed(node.childNodeTree))
+
+# 后序: 子节点先于父节点
+def walkTreePost(root:ConfigurationNode, prune = None):
+	stack = [(root, iter(()) if prune is not None and prune(root) else iter(root.childNodeTree))]
+	while stack:
+		node, children = stack[-1]
+		child = next(children, None)
+		if child is None:
+			stack.pop()
+			yield node
+		else:
+			stack.append((child, iter(()) if prune is not None and prune(child) else iter(child.childNodeTree)))
+
+# 进入/离开事件: 产出 (True, 节点) 与 (False, 节点), 用于同时需要先序与后序处理的场合
+def walkTreeEvents(root:ConfigurationNode, prune = None):
+	yield (True, root)
+	stack = [(root, iter(()) if prune is not None and prune(root) else iter(root.childNodeTree))]
+	while stack:
+		node, children = stack[-1]
+		child = next(children, None)
+		if child is None:
+			stack.pop()
+			yield (False, node)
+		else:
+			yield (True, child)
+			stack.append((child, iter(()) if prune is not None and prune(child) else iter(child.childNodeTree)))
+
+# 剪枝条件: 被禁用的节点, 以及开关关闭的 <e>/<c> 分组的子树
+def pruneDisabled(node:ConfigurationNode):
+	return not node.enable or ((node.identifier == "e" or node.identifier == "c") and not node.isSwitchOn())
+
 # WizardAnnotations 解析器	bfs 实现
 class ConfigurationWizard:
+	regionStartFlag = b"<<< Use Configuration Wizard in Context Menu >>>"
+	regionEndFlag = b"<<< end of configuration section >>>"
+
 	def __init__(self, file):
 		self.file = file
 		self.root = ConfigurationNode("R", None)  # 根节点
 		self.curNode = self.root
 		self.curNode.describe(f"{file}")
 		self.list = []
+		self.gates = []		# 先序排列的 <e>/<c> 分组
+		self.defines = {}	# 宏名 -> [节点], 同一 define 上的多个位域选项对应多个节点
+		self.paths = {}		# 节点路径 -> 节点
+		self.boundNodes = []	# 先序排列的已绑定 define 的节点
+		self.encoding = "utf-8"
+		self.bom = False
 
 	def getRoot(self):
 		return self.root
 	
-	def parseAnnotations(self):
+	def parseAnnotations(self, data:bytes = None):
 		tokenRegex = "|".join("(?P<%s>%s)" % pair for pair in tokenSpecification)
-		lineNum = 0
 		lineOffset = 0
 		skipToken = -0xf0		# | 标志位 | <- -0xf0 -> | 记录 <c?> | <- 0 -> | 保存跳过 token 个数 |
 								# -0xf0:不在区域内		-0xf1: 在区域内		-0xf2:跳过该行全部节点的创建
-		with open(self.file, "r") as f:
-			nodeSlot = []
-			for line in f.readlines():
-				lineNum += 1			
-				i = 0
-				skipToken = 0 if skipToken == -0xf2 else skipToken
-				for matchObj in re.finditer(tokenRegex, line):
-					kind = matchObj.lastgroup
-					if skipToken > 0:	# 跳过该行接下来的 token (用于<?.x>)// 不建议使用
-						skipToken -= 1
-						skipToken = -0xf1 if skipToken == 0 else skipToken
-						continue
-					elif -0xf0 < skipToken and skipToken < 0:	# 保存 <c> 的状态
-						skipToken += 1	
-						if skipToken == 0:
-							skipToken = -0xf1
-							self.curNode.bindingDefineValue = 0 if kind == "DEFINE" else 1
-					thisToken = matchObj.group()
-					startCol = matchObj.start() - lineOffset
-					endCol = matchObj.end() - lineOffset
-					# 寻找起止符
-					if kind == "REGIONSTART":
+		if data is None:
+			with open(self.file, "rb") as f:
+				data = f.read()
+		nodeSlot = []
+		for lineNum, line in self.__regionLines(data):
+			i = 0
+			skipToken = 0 if skipToken == -0xf2 else skipToken
+			for matchObj in re.finditer(tokenRegex, line):
+				kind = matchObj.lastgroup
+				if skipToken > 0:	# 跳过该行接下来的 token (用于<?.x>)// 不建议使用
+					skipToken -= 1
+					skipToken = -0xf1 if skipToken == 0 else skipToken
+					continue
+				elif -0xf0 < skipToken and skipToken < 0:	# 保存 <c> 的状态
+					skipToken += 1	
+					if skipToken == 0:
 						skipToken = -0xf1
-						continue
-					elif kind == "REGIONEND":
-						skipToken = -0xf0
-					if skipToken == -0xf0:
-						continue 
-					# 解析 token
-					if i == 0 and kind == "DEFINE":
-						expr = re.search(r"([\S]{1,}?)[ \t]{1,}?((L{0,1}\".*\")|([\S]{1,}))", line[endCol:])	# 宏名、宏值不允许有空格(又不是函数要什么空格)
-						_defineName = str(expr.group(1))
-						_defineValue = str(expr.group(2))
-						if nodeSlot.__len__() != 0:
-							for _node in nodeSlot:
-								_node.bindingDefineName  = _defineName 
-								_node.bindingDefineValue = _defineValue
-						nodeSlot.clear()
-						continue
-					elif i == 0 and kind != "STARTFLAG":
-						raise RuntimeError(f"必须以注释符(//)开始 {self.file}:{lineNum}")
-					elif kind == "HEADING":
-						thisNode = ConfigurationNode("h", self.curNode)
-						thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
-						self.curNode.addChild(thisNode)
-						self.curNode = thisNode
-						continue
-					elif kind == "CHECKHEADING":
-						thisNode = ConfigurationNode("e", self.curNode)
+						self.curNode.bindingDefineValue = 0 if kind == "DEFINE" else 1
+				thisToken = matchObj.group()
+				startCol = matchObj.start() - lineOffset
+				endCol = matchObj.end() - lineOffset
+				# 寻找起止符
+				if kind == "REGIONSTART":
+					skipToken = -0xf1
+					continue
+				elif kind == "REGIONEND":
+					skipToken = -0xf0
+				if skipToken == -0xf0:
+					continue 
+				# 解析 token
+				if i == 0 and kind == "DEFINE":
+					expr = re.search(r"([\S]{1,}?)[ \t]{1,}?((L{0,1}\".*\")|([\S]{1,}))", line[endCol:])	# 宏名、宏值不允许有空格(又不是函数要什么空格)
+					_defineName = str(expr.group(1))
+					_defineValue = str(expr.group(2))
+					if nodeSlot.__len__() != 0:
+						register = DefineRegister(_defineName, _defineValue, lineNum)
+						pending = []
+						for _node in nodeSlot:
+							if _node.skipDefine > 0:	# <on> 绑定之后第 n 个 define
+								_node.skipDefine -= 1
+								pending.append(_node)
+								continue
+							_node.bindingDefineName  = _defineName 
+							_node.defineLine = lineNum
+							_node.shift = (_node.mask & -_node.mask).bit_length() - 1 if _node.mask != 0 else 0
+							_node.register = register
+							register.nodes.append(_node)
+						nodeSlot[:] = pending
+					continue
+				elif i == 0 and kind != "STARTFLAG":
+					raise RuntimeError(f"必须以注释符(//)开始 {self.file}:{lineNum}")
+				elif kind == "HEADING":
+					thisNode = ConfigurationNode("h", self.curNode)
+					thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
+					self.curNode.addChild(thisNode)
+					self.curNode = thisNode
+					continue
+				elif kind == "CHECKHEADING":
+					thisNode = ConfigurationNode("e", self.curNode)
+					thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
+					nodeSlot.append(thisNode)
+					self.curNode.addChild(thisNode)
+					self.curNode = thisNode
+					if "." in thisToken:
+						expr = re.findall(r"\.[0-9][0-9]*", thisToken)[0][1:]
+						a = int(expr)
+						thisNode.mask = (1 << a)
+					else:
+						thisNode.mask = 1
+						# print("mask:{:b}".format(thisNode.mask))
+					continue
+				elif kind == "NUMOPT":
+					if skipToken == -0xf2:
+						thisNode = self.curNode.childNodeTree[-1]
+					else:
+						skipToken = -0xf2
+						thisNode = ConfigurationNode("o", self.curNode)
 						thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
+						thisNode.step = 1
 						nodeSlot.append(thisNode)
 						self.curNode.addChild(thisNode)
-						self.curNode = thisNode
-						if "." in thisToken:
-							expr = re.findall(r"\.[0-9][0-9]*", thisToken)[0][1:]
-							a = int(expr)
-							thisNode.mask = (1 << a)
-						else:
-							thisNode.mask = 1
-							# print("mask:{:b}".format(thisNode.mask))
-						continue
-					elif kind == "NUMOPT":
-						if skipToken == -0xf2:
-							thisNode = self.curNode.childNodeTree[-1]
-						else:
-							skipToken = -0xf2
-							thisNode = ConfigurationNode("o", self.curNode)
-							thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
-							thisNode.step = 1
-							nodeSlot.append(thisNode)
-							self.curNode.addChild(thisNode)
-						# 匹配变体 <on> <on.i> <o.i> <o.x..y>
-						expr = re.findall(r"[0-9.]*", line[startCol + 2 : endCol])[0]
-						if len(expr) != 0:
-							# <on
-							if expr[0] != ".":
-								thisNode.skipDefine = int(re.findall(r"[0-9]*", expr)[0])
-							# <on.x..y
-							expr = re.findall(r"\.[0-9][0-9]*", expr)
-							match len(expr):
-								case 0:
-									pass
-								case 1:  # .x
-									a = int(expr[0][1:])
-									thisNode.mask = thisNode.mask | (1 << a)
-									# print("mask:{:b}".format(thisNode.mask))
-								case 2:  # .x..y
-									if line[startCol + 2 : endCol].find("..") == -1:
-										raise RuntimeError(f"语法错误 {self.file}:{lineNum}")
-									a = int(expr[0][1:])
-									b = int(expr[1][1:])
-									if a > b:
-										c = a
-										a = b
-										b = c
-									while a <= b:
-										thisNode.mask |= 1 << a
-										a += 1
-									# print("mask:{:b}".format(thisNode.mask))
-									pass
-								case _:
+					# 匹配变体 <on> <on.i> <o.i> <o.x..y>
+					expr = re.findall(r"[0-9.]*", line[startCol + 2 : endCol])[0]
+					if len(expr) != 0:
+						# <on
+						if expr[0] != ".":
+							thisNode.skipDefine = int(re.findall(r"[0-9]*", expr)[0])
+						# <on.x..y
+						expr = re.findall(r"\.[0-9][0-9]*", expr)
+						match len(expr):
+							case 0:
+								pass
+							case 1:  # .x
+								a = int(expr[0][1:])
+								thisNode.mask = thisNode.mask | (1 << a)
+								# print("mask:{:b}".format(thisNode.mask))
+							case 2:  # .x..y
+								if line[startCol + 2 : endCol].find("..") == -1:
 									raise RuntimeError(f"语法错误 {self.file}:{lineNum}")
+								a = int(expr[0][1:])
+								b = int(expr[1][1:])
+								if a > b:
+									c = a
+									a = b
+									b = c
+								while a <= b:
+									thisNode.mask |= 1 << a
+									a += 1
+								# print("mask:{:b}".format(thisNode.mask))
+								pass
+							case _:
+								raise RuntimeError(f"语法错误 {self.file}:{lineNum}")
+
+					continue
+				elif kind == "HELPINFO":
+					thisNode = ConfigurationNode("i", self.curNode)
+					thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
+					if len(self.curNode.childNodeTree) == 0:
+						self.curNode.addInfo(re.findall(r"[^<\n]*", line[endCol:])[0])
+					else:
+						self.curNode.childNodeTree[-1].addInfo(re.findall(r"[^<\n]*", line[endCol:])[0])
+					continue
+				elif kind == "STRING":
+					thisNode = ConfigurationNode("s", self.curNode)
+					thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
+					nodeSlot.append(thisNode)
+					self.curNode.addChild(thisNode)
+					continue
+				elif kind == "RANGEMODIFIER":
+					# 匹配范围控制
+					### 讨厌这个正则表达式 就能不能和vscode正则一致么 🤬艹艹艹艹艹
+					_rangeToken = [
+						("lower", r"((<)(([0-9]{1,}\.{1}[0-9]{1,})|[0-9]*))"),
+						("upper", r"(((\.)|(-))(([0-9]{1,}\.{1}[0-9]{1,})|[0-9]{1,}))"),
+						("step", r"((:)(([0-9]{1,}\.[0-9]{1,})|[0-9]{1,}))"),
+					]
+					rangeRegex = "|".join("(?P<%s>%s)" % pair for pair in _rangeToken)
+					for matchObj in re.finditer(rangeRegex, thisToken):
+						rangeKind = matchObj.lastgroup
+						rangeToken = matchObj.group()
+						value = rangeToken[1:]
+						value = float(value) if "." in value else int(value)
+						match rangeKind:
+							case "upper":
+								thisNode.upperLimit = value
+
+							case "lower":
+								thisNode.lowerLimit = value
+
+							case "step":
+								thisNode.step = value
+					# if ("." in thisNode.upperLimit or "." in thisNode.lowerLimit) and thisNode.step is None:
+					# 	thisNode.step = 1e-10
+					if (isinstance(thisNode.upperLimit, int) and isinstance(thisNode.lowerLimit, int)) and thisNode.step is None:
+						thisNode.step = int(1)
+					# print(f"{thisNode.lowerLimit}:{thisNode.step}:{thisNode.upperLimit}")
+					continue
+				elif kind == "MODIFIER":
+					thisNode.modifier = thisToken[2:-1]
+					continue
+				elif kind == "NOTIFICATION":
+					thisNode = ConfigurationNode("n", self.curNode)
+					thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
+					self.curNode.addChild(thisNode)
+					continue
+				elif kind == "ESCAPE":
+					if self.curNode.identifier in thisToken:
+						if self.curNode.identifier == "c" :
+							self.curNode.bindingDefineValue ^= self.curNode.mask
+						self.curNode = self.curNode.lastNode
 
-						continue
-					elif kind == "HELPINFO":
-						thisNode = ConfigurationNode("i", self.curNode)
-						thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
-						if len(self.curNode.childNodeTree) == 0:
-							self.curNode.addInfo(re.findall(r"[^<\n]*", line[endCol:])[0])
-						else:
-							self.curNode.childNodeTree[-1].addInfo(re.findall(r"[^<\n]*", line[endCol:])[0])
-						continue
-					elif kind == "STRING":
-						thisNode = ConfigurationNode("s", self.curNode)
-						thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
-						nodeSlot.append(thisNode)
-						self.curNode.addChild(thisNode)
-						continue
-					elif kind == "RANGEMODIFIER":
-						# 匹配范围控制
-						### 讨厌这个正则表达式 就能不能和vscode正则一致么 🤬艹艹艹艹艹
-						_rangeToken = [
-							("lower", r"((<)(([0-9]{1,}\.{1}[0-9]{1,})|[0-9]*))"),
-							("upper", r"(((\.)|(-))(([0-9]{1,}\.{1}[0-9]{1,})|[0-9]{1,}))"),
-							("step", r"((:)(([0-9]{1,}\.[0-9]{1,})|[0-9]{1,}))"),
-						]
-						rangeRegex = "|".join("(?P<%s>%s)" % pair for pair in _rangeToken)
-						for matchObj in re.finditer(rangeRegex, thisToken):
-							rangeKind = matchObj.lastgroup
-							rangeToken = matchObj.group()
-							value = rangeToken[1:]
-							value = float(value) if "." in value else int(value)
-							match rangeKind:
-								case "upper":
-									thisNode.upperLimit = value
-
-								case "lower":
-									thisNode.lowerLimit = value
-
-								case "step":
-									thisNode.step = value
-						# if ("." in thisNode.upperLimit or "." in thisNode.lowerLimit) and thisNode.step is None:
-						# 	thisNode.step = 1e-10
-						if (isinstance(thisNode.upperLimit, int) and isinstance(thisNode.lowerLimit, int)) and thisNode.step is None:
-							thisNode.step = int(1)
-						# print(f"{thisNode.lowerLimit}:{thisNode.step}:{thisNode.upperLimit}")
-						continue
-					elif kind == "NOTIFICATION":
-						thisNode = ConfigurationNode("n", self.curNode)
-						thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
-						self.curNode.addChild(thisNode)
-						continue
-					elif kind == "ESCAPE":
-						if self.curNode.identifier in thisToken:
-							if self.curNode.identifier == "c" :
-								self.curNode.bindingDefineValue ^= self.curNode.mask
-							self.curNode = self.curNode.lastNode
-
-						else:
-							raise RuntimeError(f"无法匹配对应起始符 {file}:{lineNum}")
-					elif kind == "CODEENABLE" :
-						thisNode = ConfigurationNode("c", self.curNode)
-						thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
-						self.curNode.addChild(thisNode)
-						self.curNode = thisNode
-						# 判断是正选还是负选
-						if "!" in thisToken:
-							self.mask = 1
-						else:
-							self.mask = 0
-						# 判断跳过行数
-						value = re.search("c[0-9]*", thisToken)[0][1:]
-						self.skipItem = int(value) if len(value) > 0 else 0
-						skipToken = -self.skipItem
-						continue
-					elif kind == "FLAG":
-						thisNode = ConfigurationNode("q", self.curNode)
-						nodeSlot.append(thisNode)
-						thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
-						self.curNode.addChild(thisNode)
-						thisNode.mask = 1
-					elif kind == "SYMBOL_NUMBER":
-						thisNode = ConfigurationNode("y", self.curNode)
-						nodeSlot.append(thisNode)
-						thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
-						self.curNode.addChild(thisNode)
-						continue
-					elif kind == "LISTITEM":
-						if self.curNode.childNodeTree.__len__ != 0:
-							_node = self.curNode.childNodeTree[-1]
-						else :
-							_node = self.curNode
-						_node.comboListValue.append(re.search(r"<((([0-9]{1,}\.{1}[0-9]{1,})|[0-9]*)|[\S]*?)=>", thisToken).group(1))
-						_node.comboListName.append(re.findall(r"[^<\n]*", line[endCol:])[0])
-						continue
-					elif kind == "DEFAULT":
-						string = re.findall(r" *([\S ]*)", line[endCol:])[0]
-						if len(self.curNode.childNodeTree)  != 0:
-							self.curNode.childNodeTree[-1].default = string
-						else:
-							self.curNode.default = string
-						continue
 					else:
-						pass
-					i += 1
-		f.close()
+						raise RuntimeError(f"无法匹配对应起始符 {self.file}:{lineNum}")
+				elif kind == "CODEENABLE" :
+					thisNode = ConfigurationNode("c", self.curNode)
+					thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
+					self.curNode.addChild(thisNode)
+					self.curNode = thisNode
+					# 判断是正选还是负选
+					if "!" in thisToken:
+						self.mask = 1
+					else:
+						self.mask = 0
+					# 判断跳过行数
+					value = re.search("c[0-9]*", thisToken)[0][1:]
+					self.skipItem = int(value) if len(value) > 0 else 0
+					skipToken = -self.skipItem
+					continue
+				elif kind == "FLAG":
+					thisNode = ConfigurationNode("q", self.curNode)
+					nodeSlot.append(thisNode)
+					thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
+					self.curNode.addChild(thisNode)
+					thisNode.mask = (1 << int(thisToken[3:-1])) if "." in thisToken else 1
+				elif kind == "SYMBOL_NUMBER":
+					thisNode = ConfigurationNode("y", self.curNode)
+					nodeSlot.append(thisNode)
+					thisNode.describe(re.findall(r"[^<\n]*", line[endCol:])[0])
+					self.curNode.addChild(thisNode)
+					continue
+				elif kind == "LISTITEM":
+					if self.curNode.childNodeTree.__len__ != 0:
+						_node = self.curNode.childNodeTree[-1]
+					else :
+						_node = self.curNode
+					_node.comboListValue.append(re.search(r"<((([0-9]{1,}\.{1}[0-9]{1,})|[0-9]*)|[\S]*?)=>", thisToken).group(1))
+					_node.comboListName.append(re.findall(r"[^<\n]*", line[endCol:])[0])
+					continue
+				elif kind == "DEFAULT":
+					string = re.findall(r" *([\S ]*)", line[endCol:])[0]
+					if len(self.curNode.childNodeTree)  != 0:
+						self.curNode.childNodeTree[-1].default = string
+					else:
+						self.curNode.default = string
+					continue
+				else:
+					pass
+				i += 1
 		if self.curNode != self.root:
 			raise RuntimeError("配置信息已读取，但对应 Token 结束符")
 		if skipToken != -0xf0:
 			raise RuntimeError("配置信息已读取，但缺少区域结束标志")
+		self.__linkTree()
+
+	# 解析完成后一次先序遍历: 建立 <e>/<c> 使能依赖, 以及按宏名/节点路径的查找表
+	def __linkTree(self):
+		enclosing = [None]		# 进入/离开事件维护: 当前所在的 <e>/<c> 分组
+		names = []				# 以及当前节点路径上的各级描述
+		for entering, node in walkTreeEvents(self.root):
+			isGate = node.identifier == "e" or node.identifier == "c"
+			if not entering:
+				if isGate:
+					enclosing.pop()
+				if node.identifier != "R":
+					names.pop()
+				continue
+			gate = enclosing[-1]
+			node.enableGate = gate
+			if gate is not None:
+				gate.gatedNodes.append(node)
+			if node.identifier != "R":
+				names.append(str(node.description).strip())
+				self.paths.setdefault("/".join(names), node)
+			if node.bindingDefineName is not None:
+				self.defines.setdefault(node.bindingDefineName, []).append(node)
+				self.boundNodes.append(node)
+			if isGate:
+				self.gates.append(node)
+				enclosing.append(node)
+		self.refreshEnable()
+
+	# 重新计算全部节点的有效使能状态 (用于批量修改之后)
+	def refreshEnable(self):
+		for gate in self.gates:	# 先序: 外层分组先于内层分组
+			state = gate.enable and gate.isSwitchOn()
+			for node in gate.gatedNodes:
+				node.enable = state
+
+	# 将带有 <d> 的选项恢复为默认值, 返回被修改的节点
+	# 数字/列表选项: <d> 后的整段文字与某个列表项名称相同时取该项的值, 否则约定第一个值为复位值
+	# 字符串选项(<s>/<y>): 取 <d> 后的整段文字, 引号不成对时不写入
+	# refresh 为 False 时由调用者统一刷新使能状态(如 WizardTreeViewer.bulkUpdate)
+	def resetToDefault(self, refresh = True):
+		changed = []
+		for node in self.boundNodes:
+			if node.default is None or node.default.strip() == "":
+				continue
+			names = [name.strip() for name in node.comboListName]
+			value = node.default.strip()
+			if node.identifier == "s" or node.identifier == "y":
+				if value.replace('\\"', "").count('"') % 2 != 0:
+					continue
+			elif value in names:
+				value = node.comboListValue[names.index(value)]
+			else:
+				value = value.split()[0]
+				if value not in node.comboListValue and value in names:
+					value = node.comboListValue[names.index(value)]
+			if ConfigurationWizard.checkValue(node, value) is not None or str(node.getValue()) == value:
+				continue
+			node.setValue(value)
+			changed.append(node)
+		if refresh:
+			self.refreshEnable()
+		return changed
+
+	# 自底向上计算每个节点的子树哈希(Merkle), 返回根节点哈希
+	def hashTree(self):
+		for node in walkTreePost(self.root):	# 子节点先于父节点
+			digest = hashlib.blake2b(digest_size=16)
+			value = normalizeValue(node.getValue()) if node.bindingDefineName is not None else ""	# 位域选项只比较自己的位段
+			description = str(node.description).strip() if node.identifier != "R" else ""
+			digest.update(f"{node.identifier}\0{description}\0{node.bindingDefineName}\0{node.mask}\0{value}\0".encode("utf-8"))
+			for child in node.childNodeTree:
+				digest.update(child.subtreeHash)
+			node.subtreeHash = digest.digest()
+		return self.root.subtreeHash
+
+	# 逐行产出配置区域内的 (行号, 文本)
+	# 在字节上定位区域, 区域外的行以及区域内既无注释也无 #define 的行不做解码
+	def __regionLines(self, data:bytes):
+		self.bom = data.startswith(codecs.BOM_UTF8)
+		self.encoding = "utf-8"
+		head = len(codecs.BOM_UTF8) if self.bom else 0
+		pos = data.find(ConfigurationWizard.regionStartFlag, head)
+		while pos != -1:
+			begin = max(data.rfind(b"\n", 0, pos) + 1, head)
+			end = data.find(ConfigurationWizard.regionEndFlag, pos)
+			stop = data.find(b"\n", end) if end != -1 else -1
+			stop = len(data) if stop == -1 else stop
+			lineNum = data.count(b"\n", 0, begin)
+			for rawLine in data[begin:stop].split(b"\n"):
+				lineNum += 1
+				if b"//" not in rawLine and b"#define" not in rawLine:
+					continue
+				rawLine = rawLine.rstrip(b"\r")
+				try:
+					line = rawLine.decode(self.encoding)
+				except UnicodeDecodeError:
+					if self.encoding == fallbackEncoding:
+						raise RuntimeError(f"无法解码 {self.file}:{lineNum}")
+					self.encoding = fallbackEncoding
+					try:
+						line = rawLine.decode(self.encoding)
+					except UnicodeDecodeError:
+						raise RuntimeError(f"无法解码 {self.file}:{lineNum}")
+				yield lineNum, line
+			pos = data.find(ConfigurationWizard.regionStartFlag, stop) if end != -1 else -1
+
+	def toList(self, skipDisabled = False):
+		nodes = (node for node in walkTree(self.root, pruneDisabled) if node.enable and node.bindingDefineName is not None) if skipDisabled else self.boundNodes
+		self.list = [ConfigurationListItem(node.identifier, node.bindingDefineName, node.bindingDefineValue, node.defineLine, node)
+			for node in nodes if node.identifier in ("e", "o", "q", "s", "y")]
+		return self.list
 
-	def __getListItemFormTree(self, thisNode:ConfigurationNode):
-		if thisNode.identifier == "h" or thisNode.identifier == "R":
-			for childNode in thisNode.childNodeTree:
-				self.__getListItemFormTree(childNode)
-		elif thisNode.identifier == "e" :
-			self.list.append(ConfigurationListItem(thisNode.identifier, thisNode.bindingDefineName, thisNode.bindingDefineValue))
-			for childNode in thisNode.childNodeTree:
-				self.__getListItemFormTree(childNode)
-		elif thisNode.identifier == "o" :
-			self.list.append(ConfigurationListItem(thisNode.identifier, thisNode.bindingDefineName, thisNode.bindingDefineValue))
-		elif thisNode.identifier == "q":
-			self.list.append(ConfigurationListItem(thisNode.identifier, thisNode.bindingDefineName, thisNode.bindingDefineValue))
-		elif thisNode.identifier == "s":
-			self.list.append(ConfigurationListItem(thisNode.identifier, thisNode.bindingDefineName, thisNode.bindingDefineValue))
-		elif thisNode.identifier == "y":
-			self.list.append(ConfigurationListItem(thisNode.identifier, thisNode.bindingDefineName, thisNode.bindingDefineValue))
+	# 按宏名或节点路径(如 "Thread Configuration/Number of concurrent running threads")查找节点
+	def node(self, key):
+		nodes = self.defines.get(key)
+		if nodes is not None:
+			return nodes[0]
+		node = self.paths.get(key)
+		if node is None:
+			raise RuntimeError(f"未找到配置项 {key} {self.file}")
+		return node
+
+	# 宏名对应多个位域选项时返回整个宏值, 否则返回选项值
+	def get(self, key):
+		nodes = self.defines.get(key)
+		if nodes is not None and len(nodes) > 1:
+			number = parseNumber(nodes[0].bindingDefineValue)
+			return number if number is not None else nodes[0].bindingDefineValue
+		return self.node(key).typedValue()
+
+	# 按选项类型写入, 写入前检查列表/范围/步长/位宽, 不满足时抛出 RuntimeError
+	def set(self, key, value):
+		self.setMany({key: value})
+
+	def getMany(self, keys):
+		return {key: self.get(key) for key in keys}
+
+	# 全部检查通过后才写入
+	def setMany(self, values:dict):
+		checked = [self.__check(key, value) for key, value in values.items()]
+		for node, value in checked:
+			self.__apply(node, value)
+
+	# 返回 (写入目标, 检查后的值), 宏名对应多个位域选项时检查每个位段并以共享的 DefineRegister 为目标
+	def __check(self, key, value):
+		nodes = self.defines.get(key)
+		if nodes is not None and len(nodes) > 1:
+			number = parseNumber(value)
+			for node in nodes:
+				field = str((number & node.mask) >> node.shift) if node.mask != 0 and isinstance(number, int) else str(value)
+				error = ConfigurationWizard.checkValue(node, field)
+				if error is not None:
+					raise RuntimeError(error)
+			register = nodes[0].register
+			if isinstance(number, int) and number < 0 and register.value is not None and register.base != 10:
+				raise RuntimeError(f"{key}: {value} 十六进制/八进制宏值不能为负数")
+			return (register, str(value))
+		node = self.node(key)
+		return (node, self.__checkNode(node, value))
+
+	def __checkNode(self, node:ConfigurationNode, value):
+		if isinstance(node.typedValue(), bool):
+			if isinstance(value, bool):
+				return value
+			if str(value).strip() in ("0", "1"):
+				return str(value).strip() == "1"
+			raise RuntimeError(f"{node.bindingDefineName}: 需要 bool 值")
+		value = str(value)
+		error = ConfigurationWizard.checkValue(node, value)
+		if error is not None:
+			raise RuntimeError(error)
+		return value
+
+	def __apply(self, target, value):
+		if isinstance(target, DefineRegister):
+			number = parseNumber(value)
+			if target.value is not None and isinstance(number, int):
+				target.setNumber(number)	# 保留原有的进制、位宽、大小写与后缀
+			else:
+				target.setText(value)
+			for node in target.nodes:
+				if len(node.gatedNodes) != 0:
+					node.propagateEnable()
+			return
+		if isinstance(value, bool):
+			target.setSwitch(value)
 		else:
-			pass
-	
-	def toList(self):
-		self.list.clear()
-		self.__getListItemFormTree(self.root)
-		return self.list
+			target.setValue(value)
+		if len(target.gatedNodes) != 0:
+			target.propagateEnable()
+
+	# 检查 value 是否满足节点的列表/范围/步长约束, 满足时返回 None, 否则返回错误信息
+	@staticmethod
+	def checkValue(node:ConfigurationNode, value:str):
+		if node.identifier not in ("e", "o", "q"):
+			return None
+		if len(node.comboListValue) != 0:	# 按数值匹配, 如 0x2 与 2
+			if value not in node.comboListValue and all(normalizeValue(item) != normalizeValue(value) for item in node.comboListValue):
+				return f"{node.bindingDefineName}: {value} 不在可选列表 {node.comboListValue} 内"
+			return None
+		number = parseNumber(value)
+		if number is None:
+			return f"{node.bindingDefineName}: {value} 不是有效数字"
+		if number < 0 and node.register is not None and node.register.value is not None and node.register.base != 10:
+			return f"{node.bindingDefineName}: {value} 十六进制/八进制宏值不能为负数"
+		if node.modifier is not None:	# 范围与步长针对显示值
+			operand = parseNumber(node.modifier[1:])
+			match node.modifier[0]:
+				case "+": number -= operand
+				case "-": number += operand
+				case "*": number /= operand
+				case "/": number *= operand
+			if isinstance(number, float) and number.is_integer():
+				number = int(number)
+		if node.lowerLimit is not None and not (node.lowerLimit <= number <= node.upperLimit):
+			return f"{node.bindingDefineName}: {value} 超出范围 {node.lowerLimit}-{node.upperLimit}"
+		if node.lowerLimit is None and node.mask != 0 and not (0 <= number <= (node.mask >> node.shift)):
+			return f"{node.bindingDefineName}: {value} 超出位段范围 0-{node.mask >> node.shift}"
+		if isinstance(node.step, int) and isinstance(number, int) and number % node.step != 0:
+			return f"{node.bindingDefineName}: {value} 不是步长 {node.step} 的整数倍"
+		return None
 
 class Writer:
-	def __init__(self, path):
+	def __init__(self, path, encoding = "utf-8"):
 		if path is None:
 			raise RuntimeError(f"路径为空")
 		
 		self.path = path
+		self.encoding = encoding
 
+	# 按字节逐行写回, 仅改写绑定 define 所在行的宏值, 其余字节(编码、BOM、换行符、缩进、行尾注释)原样保留
 	def writeFile(self, list:list[ConfigurationListItem]):
-		index = 0
-		with open(self.path, "r") as originalFile:
-			with open(f"{self.path}.h", "w") as newlFile:
-				for line in originalFile.readlines():
-					if index < len(list):
-						match = re.search(f".*#define {{1,}}{list[index].targetName}", line)
-						if match:
-							newlFile.write(f"#define {list[index].targetName} {list[index].targetValue}\n")
-							index += 1
-							continue
-					newlFile.write(line)
-				originalFile.close()
-				newlFile.close()
-				if SafeMode == 1:
-					if os.path.exists(f"{self.path}.bak"):
-						os.remove(f"{self.path}.bak")
-					os.rename(self.path, f"{self.path}.bak")
-					os.rename(f"{self.path}.h", self.path)
+		with open(self.path, "rb") as originalFile:
+			lines = originalFile.read().split(b"\n")
+		pending = {}	# 同一 define 上的多个位域选项已合成到同一个值, 每个 define 只写一次
+		for item in list:
+			if item.targetName is not None and item.targetLine is not None:
+				pending[item.targetLine] = item
+		for item in pending.values():
+			index = item.targetLine - 1
+			expr = re.compile(rb"(#define[ \t]+" + re.escape(item.targetName.encode(self.encoding)) + rb"[ \t]+)(L?\".*\"|\S+)")
+			match = expr.search(lines[index]) if index < len(lines) else None
+			if match is None:
+				raise RuntimeError(f"无法定位宏定义 {item.targetName} {self.path}:{item.targetLine}")
+			value = str(item.targetValue).encode(self.encoding)
+			lines[index] = lines[index][:match.start(2)] + value + lines[index][match.end(2):]
+		with open(f"{self.path}.h", "wb") as newlFile:
+			newlFile.write(b"\n".join(lines))
+		if SafeMode == 1:
+			if os.path.exists(f"{self.path}.bak"):
+				os.remove(f"{self.path}.bak")
+			os.rename(self.path, f"{self.path}.bak")
+			os.rename(f"{self.path}.h", self.path)
+		else:
+			os.remove(self.path)
+			os.rename(f"{self.path}.h", self.path)
+
+# 常驻服务模式: stdio 上的 JSON-RPC 2.0 (每行一个请求), 供编辑器插件使用
+# 已解析的配置树常驻内存, 仅当文件 mtime/大小 变化时重新解析
+class ConfigurationServer:
+	def __init__(self, istream = None, ostream = None):
+		self.istream = istream if istream is not None else sys.stdin
+		self.ostream = ostream if ostream is not None else sys.stdout
+		self.cache = {}		# 绝对路径 -> [文件戳, ConfigurationWizard]
+		self.methods = {
+			"get"		: self.get,
+			"set"		: self.set,
+			"list"		: self.list,
+			"validate"	: self.validate,
+			"save"		: self.save,
+			"reset"		: self.reset,
+		}
+
+	def serve(self):
+		for line in self.istream:
+			if line.strip() == "":
+				continue
+			response = self.handle(line)
+			if response is not None:
+				self.ostream.write(json.dumps(response) + "\n")
+				self.ostream.flush()
+
+	def handle(self, text):
+		try:
+			request = json.loads(text)
+		except ValueError as e:
+			return self.__error(None, -32700, f"Parse error: {e}")
+		if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+			return self.__error(request.get("id") if isinstance(request, dict) else None, -32600, "Invalid Request")
+		requestId = request.get("id")
+		method = self.methods.get(request["method"])
+		if method is None:
+			return self.__error(requestId, -32601, f"Method not found: {request['method']}")
+		params = request.get("params", {})
+		if not isinstance(params, dict) or not isinstance(params.get("file"), str):
+			return self.__error(requestId, -32602, "Invalid params: 需要 file 参数")
+		try:
+			inspect.signature(method).bind(**params)
+		except TypeError as e:
+			return self.__error(requestId, -32602, f"Invalid params: {e}")
+		try:
+			result = method(**params)
+		except (RuntimeError, OSError) as e:
+			return self.__error(requestId, -32000, str(e))
+		except Exception as e:		# 常驻进程不能因单个请求退出
+			return self.__error(requestId, -32603, f"Internal error: {type(e).__name__}: {e}")
+		if requestId is None:	# 通知不需要回复
+			return None
+		return {"jsonrpc": "2.0", "id": requestId, "result": result}
+
+	def __error(self, requestId, code, message):
+		return {"jsonrpc": "2.0", "id": requestId, "error": {"code": code, "message": message}}
+
+	def load(self, file):
+		path = os.path.abspath(file)
+		stat = os.stat(path)
+		stamp = (stat.st_mtime_ns, stat.st_size)
+		entry = self.cache.get(path)
+		if entry is None or entry[0] != stamp:
+			wizard = ConfigurationWizard(path)
+			wizard.parseAnnotations()
+			entry = [stamp, wizard]
+			self.cache[path] = entry
+		return entry
+
+	# 宏名对应多个位域选项时描述整个宏, 各选项在 fields 中; 否则描述单个选项
+	def __describe(self, wizard:ConfigurationWizard, name):
+		nodes = wizard.defines.get(name)
+		if nodes is not None and len(nodes) > 1:
+			return {"name": name, "value": wizard.get(name), "fields": [self.__describeNode(node) for node in nodes]}
+		return self.__describeNode(wizard.node(name))
+
+	def __describeNode(self, node:ConfigurationNode):
+		return {
+			"name"			: node.bindingDefineName,
+			"path"			: node.path(),
+			"value"			: node.typedValue(),
+			"identifier"	: node.identifier,
+			"description"	: node.description,
+			"default"		: node.default,
+			"range"			: None if node.lowerLimit is None else [node.lowerLimit, node.upperLimit, node.step],
+			"options"		: dict(zip(node.comboListValue, node.comboListName)),
+			"help"			: "\n".join(node.helpInfo),
+			"enabled"		: node.enable,
+		}
+
+	def get(self, file, name):
+		return self.__describe(self.load(file)[1], name)
+
+	def set(self, file, name, value):
+		wizard = self.load(file)[1]
+		wizard.set(name, value)
+		return self.__describe(wizard, name)
+
+	def list(self, file):
+		wizard = self.load(file)[1]
+		return [self.__describe(wizard, name) for name in wizard.defines]
+
+	def validate(self, file):
+		problems = []
+		for node in walkTree(self.load(file)[1].getRoot(), pruneDisabled):	# 跳过被禁用分组内的选项
+			if node.bindingDefineName is None or not node.enable:
+				continue
+			error = ConfigurationWizard.checkValue(node, str(node.getValue()))
+			if error is not None:
+				problems.append({"name": node.bindingDefineName, "description": node.description, "message": error})
+		return problems
+
+	def reset(self, file):
+		return [node.bindingDefineName for node in self.load(file)[1].resetToDefault()]
+
+	def save(self, file):
+		entry = self.load(file)
+		Writer(entry[1].file, entry[1].encoding).writeFile(entry[1].toList())
+		stat = os.stat(entry[1].file)
+		entry[0] = (stat.st_mtime_ns, stat.st_size)	# 自己写入的修改无需重新解析
+		return True
+
+# 跨头文件宏定义索引: 记录目录树内所有配置头文件中绑定的宏 -> 文件/行号/节点路径/当前值
+# 索引持久化在 <目录>/.cwa_index.json, 更新时只重新解析 mtime/大小 与内容哈希均发生变化的文件
+class DefineIndex:
+	indexFileName = ".cwa_index.json"
+	version = 1
+
+	def __init__(self, directory):
+		self.directory = os.path.abspath(directory)
+		self.indexFile = os.path.join(self.directory, DefineIndex.indexFileName)
+		self.files = {}		# 相对路径 -> {"stamp": [mtime_ns, size], "hash": sha1, "defines": [[宏名, 行号, 节点路径, 宏值]], "error": 解析错误}
+		self.defines = {}	# 宏名 -> [(相对路径, 行号, 节点路径, 宏值)]
+		self.load()
+
+	def load(self):
+		try:
+			with open(self.indexFile, "r", encoding="utf-8") as f:
+				content = json.load(f)
+		except (OSError, ValueError):
+			return
+		if content.get("version") == DefineIndex.version:
+			self.files = content.get("files", {})
+			self.__rebuild()
+
+	def save(self):
+		with open(self.indexFile, "w", encoding="utf-8") as f:
+			json.dump({"version": DefineIndex.version, "files": self.files}, f, ensure_ascii=False)
+
+	# 扫描目录树并更新索引, 返回重新解析的文件数
+	def update(self):
+		seen = set()
+		parsed = 0
+		changed = False
+		for folder, dirs, names in os.walk(self.directory):
+			dirs[:] = [d for d in dirs if not d.startswith(".")]
+			for name in names:
+				if not name.endswith(".h"):
+					continue
+				path = os.path.join(folder, name)
+				relative = os.path.relpath(path, self.directory).replace(os.sep, "/")
+				seen.add(relative)
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				stamp = [stat.st_mtime_ns, stat.st_size]
+				entry = self.files.get(relative)
+				if entry is not None and entry["stamp"] == stamp:
+					continue
+				try:
+					with open(path, "rb") as f:
+						data = f.read()
+				except OSError as e:		# 遍历之后被删除或无法读取
+					self.files[relative] = {"stamp": None, "hash": None, "defines": [], "error": str(e)}	# 下次重新读取
+					changed = True
+					continue
+				digest = hashlib.sha1(data).hexdigest()
+				changed = True
+				if entry is not None and entry["hash"] == digest:
+					entry["stamp"] = stamp
+					continue
+				self.files[relative] = {"stamp": stamp, "hash": digest, "defines": [], "error": None}
+				if ConfigurationWizard.regionStartFlag not in data:
+					continue
+				parsed += 1
+				wizard = ConfigurationWizard(path)
+				try:
+					wizard.parseAnnotations(data)
+				except RuntimeError as e:
+					self.files[relative]["error"] = str(e)
+					continue
+				except Exception as e:		# 单个文件解析失败不影响其余文件
+					self.files[relative]["error"] = f"{type(e).__name__}: {e}"
+					continue
+				for node in wizard.boundNodes:
+					self.files[relative]["defines"].append([node.bindingDefineName, node.defineLine, node.path(), str(node.bindingDefineValue)])
+		for relative in list(self.files.keys()):
+			if relative not in seen:
+				del self.files[relative]
+				changed = True
+		if changed:
+			self.__rebuild()
+			self.save()
+		return parsed
+
+	def __rebuild(self):
+		self.defines = {}
+		for relative, entry in self.files.items():
+			for name, line, path, value in entry["defines"]:
+				self.defines.setdefault(name, []).append((relative, line, path, value))
+
+	def find(self, name):
+		return self.defines.get(name, [])
+
+	# 在多个文件中取值不同的宏: {宏名: [(相对路径, 行号, 节点路径, 宏值)]}
+	def conflicts(self):
+		result = {}
+		for name, entries in self.defines.items():
+			if len({entry[0] for entry in entries}) > 1 and len({normalizeValue(entry[3]) for entry in entries}) > 1:
+				result[name] = entries
+		return result
+
+	def errors(self):
+		return {relative: entry["error"] for relative, entry in self.files.items() if entry["error"] is not None}
+
+	# 默认索引根目录: 向上查找含 .git 或已有索引文件的目录(工程根), 找不到时为 path 所在目录
+	@staticmethod
+	def findRoot(path):
+		start = os.path.abspath(path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path)))
+		directory = start
+		while True:
+			if os.path.exists(os.path.join(directory, ".git")) or os.path.exists(os.path.join(directory, DefineIndex.indexFileName)):
+				return directory
+			parent = os.path.dirname(directory)
+			if parent == directory:
+				return start
+			directory = parent
+
+# 结构化比较两份配置: 子树哈希相同时整棵跳过, 只报告取值不同或仅存在于一侧的选项
+class ConfigurationDiff:
+	def __init__(self, left:ConfigurationWizard, right:ConfigurationWizard):
+		self.left = left
+		self.right = right
+
+	# 节点在兄弟节点间的匹配键
+	@staticmethod
+	def key(node:ConfigurationNode):
+		return (node.identifier, str(node.description).strip(), node.bindingDefineName, node.mask)
+
+	# 返回 [{"path", "name", "left", "right"}], 仅存在于一侧时另一侧为 None
+	def compare(self):
+		differences = []
+		if self.left.hashTree() == self.right.hashTree():
+			return differences
+		stack = [(self.left.getRoot(), self.right.getRoot())]
+		while stack:
+			leftNode, rightNode = stack.pop()
+			if leftNode.subtreeHash == rightNode.subtreeHash:
+				continue
+			if leftNode.bindingDefineName is not None and normalizeValue(leftNode.getValue()) != normalizeValue(rightNode.getValue()):
+				differences.append(self.__difference(leftNode, str(leftNode.getValue()), str(rightNode.getValue())))
+			candidates = {}
+			for child in rightNode.childNodeTree:
+				candidates.setdefault(ConfigurationDiff.key(child), []).append(child)
+			pairs = []
+			for child in leftNode.childNodeTree:
+				matched = candidates.get(ConfigurationDiff.key(child))
+				if matched:
+					pairs.append((child, matched.pop(0)))
 				else:
-					os.remove(self.path)
-					os.rename(f"{self.path}.h", self.path)
-		
+					self.__collect(child, differences, True)
+			for unmatched in candidates.values():
+				for child in unmatched:
+					self.__collect(child, differences, False)
+			stack.extend(reversed(pairs))
+		return differences
+
+	def __difference(self, node:ConfigurationNode, leftValue, rightValue):
+		return {"path": node.path(), "name": node.bindingDefineName, "left": leftValue, "right": rightValue}
+
+	# 只存在于一侧的子树: 报告其中全部绑定宏定义的选项
+	def __collect(self, root:ConfigurationNode, differences, isLeft):
+		for node in walkTree(root):
+			if node.bindingDefineName is not None:
+				value = str(node.getValue())
+				differences.append(self.__difference(node, value if isLeft else None, None if isLeft else value))
+
+	# 逐对比较两个目录内相对路径相同的 .h 文件, 产出 (左文件, 右文件, 差异列表, 错误)
+	# 只存在于一侧的文件另一侧为 None; 单对文件解析失败时记录错误, 不影响其余文件
+	@staticmethod
+	def compareDirectories(leftDirectory, rightDirectory):
+		for leftFile in ConfigurationDiff.__headers(leftDirectory):
+			rightFile = os.path.join(rightDirectory, os.path.relpath(leftFile, leftDirectory))
+			if not os.path.isfile(rightFile):
+				yield leftFile, None, [], "右侧不存在该文件"
+				continue
+			yield (leftFile, rightFile) + ConfigurationDiff.tryCompareFiles(leftFile, rightFile)
+		for rightFile in ConfigurationDiff.__headers(rightDirectory):
+			leftFile = os.path.join(leftDirectory, os.path.relpath(rightFile, rightDirectory))
+			if not os.path.isfile(leftFile):
+				yield None, rightFile, [], "左侧不存在该文件"
+
+	@staticmethod
+	def __headers(directory):
+		for folder, dirs, names in os.walk(directory):
+			dirs[:] = [d for d in dirs if not d.startswith(".")]
+			for name in names:
+				if name.endswith(".h"):
+					yield os.path.join(folder, name)
+
+	# 返回 (差异列表, 错误), 解析失败时差异列表为空
+	@staticmethod
+	def tryCompareFiles(leftFile, rightFile):
+		try:
+			return ConfigurationDiff.compareFiles(leftFile, rightFile), None
+		except (RuntimeError, OSError) as e:
+			return [], str(e)
+		except Exception as e:
+			return [], f"{type(e).__name__}: {e}"
+
+	@staticmethod
+	def compareFiles(leftFile, rightFile):
+		left = ConfigurationWizard(leftFile)
+		left.parseAnnotations()
+		right = ConfigurationWizard(rightFile)
+		right.parseAnnotations()
+		return ConfigurationDiff(left, right).compare()
+
 # 重写的 widgets
 class MyValidator(QValidator):
 	def __init__(self, node, parent=None):
@@ -396,25 +1172,35 @@ class MySpinBox(QtWidgets.QSpinBox):
 	def __init__(self, node:ConfigurationNode, parent=None):
 		super().__init__(parent)
 		self.node = node
-		self.setFixedWidth(int(WizardTreeViewer.viewerTree.columnWidth(1)*0.5))
 		if node.lowerLimit is not None:
 			self.setMinimum(node.lowerLimit)
 			self.setMaximum(node.upperLimit)
+		elif node.mask != 0:	# 位段 <o.x..y>
+			self.setMinimum(0)
+			self.setMaximum(node.mask >> node.shift)
+		elif node.register is not None and node.register.value is not None and node.register.base != 10:
+			self.setMinimum(0)	# 十六进制/八进制宏值不能为负数
+			self.setMaximum(0x10000000)
 		else:
 			self.setMinimum(-(0x10000000-1))
 			self.setMaximum(0x10000000)
 		if node.step is not None:	
 			self.setSingleStep(node.step)
-		if "0x" in node.bindingDefineValue:
+		self.syncFromNode()
+		self.valueChanged.connect(self.onValueChanged)
+
+	def syncFromNode(self):
+		value = self.node.getValue()
+		if "0x" in value.lower():
 			self.setDisplayIntegerBase(16)
 			self.setPrefix("0x")
-			self.setValue(int(node.bindingDefineValue, 16))
 		else:
-			self.setValue(int(node.bindingDefineValue))
-		self.valueChanged.connect(self.onValueChanged)
+			self.setDisplayIntegerBase(10)
+			self.setPrefix("")
+		self.setValue(parseNumber(value))
 	
 	def onValueChanged(self):
-		self.node.bindingDefineValue = str(self.value())
+		self.node.setValue(self.value())
 		WizardTreeViewer.slider.setValue(self.value())
 
 	def validate(self, input, pos):
@@ -450,17 +1236,19 @@ class MyDoubleSpinBox(QtWidgets.QDoubleSpinBox):	### TODO ❗ 待完善 ❗ 不
 	def __init__(self, node:ConfigurationNode, parent=None):
 		super().__init__(parent)
 		self.node = node
-		self.setFixedWidth(int(WizardTreeViewer.viewerTree.columnWidth(1)*0.5))
 		self.setMinimum(node.lowerLimit)
 		self.setMaximum(node.upperLimit)
 		if node.step is not None:	
 			self.setSingleStep(node.step)
-		self.setDecimals(len(node.bindingDefineValue.split(".")[1]))
-		self.setValue(float(node.bindingDefineValue))
+		self.syncFromNode()
 		self.valueChanged.connect(self.onValueChanged)
+
+	def syncFromNode(self):
+		self.setDecimals(len(self.node.getValue().split(".")[1]))
+		self.setValue(float(self.node.getValue()))
 	
 	def onValueChanged(self):
-		self.node.bindingDefineValue = str(self.value())
+		self.node.setValue(str(self.value()))
 		WizardTreeViewer.slider.setValue(self.value())
 
 	def validate(self, input, pos):
@@ -516,7 +1304,7 @@ class MySlider(QtWidgets.QSlider):
 		self.setMaximum(node.upperLimit)
 		self.setSingleStep(int(node.step))
 		self.setPageStep(int(node.step))
-		self.setValue(int(node.bindingDefineValue))
+		self.setValue(parseNumber(node.getValue()))
 		self.setFixedHeight(self._height)
 		self.valueChanged.connect(self.onValueChanged)
 	
@@ -577,33 +1365,33 @@ class MyTextEditer(QtWidgets.QLineEdit):
 	def __init__(self, node, parent=None):
 		super().__init__(parent)
 		self.node = node
-		self.setFixedWidth(int(WizardTreeViewer.viewerTree.columnWidth(1)*0.5))
-		self.setText(node.bindingDefineValue)
+		self.syncFromNode()
+
+	def syncFromNode(self):
+		self.setText(self.node.bindingDefineValue)
 
 class MyCheckBox(QtWidgets.QCheckBox):
 	def __init__(self, node:ConfigurationNode, item:MyTreeWidgetItem = None  ,parent=None):
 		super().__init__(parent)
 		self.node = node
-		node.bindingDefineValue = int(node.bindingDefineValue)
 		self.treeItem = item
 		if item is not None:
-			self.changeTreeItemState()
+			item.enable = node.enable and node.isSwitchOn()
+			item.setDisabled(not item.enable)
 		# TODO windows 下无法修改 CheckBox 大小
-		if node.bindingDefineValue:
+		self.syncFromNode()
+		self.stateChanged.connect(self.onCheckboxChange)
+
+	def syncFromNode(self):
+		if self.node.isSwitchOn():
 			self.setCheckState(Qt.CheckState.Checked)
 		else:
 			self.setCheckState(Qt.CheckState.Unchecked)
-		self.stateChanged.connect(self.onCheckboxChange)
 			
 	def onCheckboxChange(self):
-		self.node.bindingDefineValue ^= self.node.mask
+		self.node.setSwitch(self.checkState() == Qt.CheckState.Checked)
 		if self.treeItem is not None:
-			self.changeTreeItemState()
-
-	def changeTreeItemState(self):
-		self.treeItem.enable = bool(self.node.bindingDefineValue != 0)
-		self.treeItem.setExpanded(self.treeItem.enable)
-		self.treeItem.setDisabled(not self.treeItem.enable)
+			WizardTreeViewer.viewerTree.applyEnableState(self.node)
 
 class MyInfoBar(QtWidgets.QTextEdit):
 	def __init__(self, parent=None):
@@ -621,20 +1409,56 @@ class MyComboBox(QtWidgets.QComboBox):
 		super().__init__(parent)
 		self.node = node
 		self.addItems(node.comboListName)
-		self.setCurrentIndex(node.comboListValue.index(node.bindingDefineValue))
+		self.syncFromNode()
 		self.currentIndexChanged.connect(self.onIndexChanged)
-		self.setFixedWidth(int(WizardTreeViewer.viewerTree.columnWidth(1)*0.5))
+
+	def syncFromNode(self):
+		value = self.node.getValue()
+		if value not in self.node.comboListValue:	# 按数值匹配, 如 0x10 与 16
+			value = next((item for item in self.node.comboListValue if normalizeValue(item) == normalizeValue(value)), value)
+		self.setCurrentIndex(self.node.comboListValue.index(value))
 
 	def onIndexChanged(self):
 		index = self.node.comboListName.index(self.currentText())
-		self.node.bindingDefineValue = self.node.comboListValue[index]
+		self.node.setValue(self.node.comboListValue[index])
 		self.hidePopup()
 
+# 统一行高: 构造时按字体与样式算出编辑控件高度, 配合 setUniformRowHeights 免去逐行测量
+class WizardItemDelegate(QtWidgets.QStyledItemDelegate):
+	def __init__(self, parent:QtWidgets.QWidget):
+		super().__init__(parent)
+		self.rowHeight = WizardItemDelegate.editorHeight(parent.style(), parent.font())
+
+	# 按 QSpinBox/QComboBox 计算 sizeHint 的方式求高度, 不创建控件
+	# QSpinBox: 无边框输入框(文字高度 + 2) -> CT_LineEdit -> CT_SpinBox
+	@staticmethod
+	def editorHeight(style:QtWidgets.QStyle, font:QtGui.QFont):
+		metrics = QtGui.QFontMetrics(font)
+		contents = QtCore.QSize(0, max(metrics.height(), 14) + 2)
+		lineEdit = QtWidgets.QStyleOptionFrame()
+		lineEdit.fontMetrics = metrics
+		lineEdit.lineWidth = 0
+		spinBox = QtWidgets.QStyleOptionSpinBox()
+		spinBox.fontMetrics = metrics
+		spinBox.frame = True
+		comboBox = QtWidgets.QStyleOptionComboBox()
+		comboBox.fontMetrics = metrics
+		comboBox.frame = True
+		lineEditSize = style.sizeFromContents(QtWidgets.QStyle.ContentsType.CT_LineEdit, lineEdit, contents)
+		return max(style.sizeFromContents(QtWidgets.QStyle.ContentsType.CT_SpinBox, spinBox, lineEditSize).height(),
+			style.sizeFromContents(QtWidgets.QStyle.ContentsType.CT_ComboBox, comboBox, contents).height())
+
+	def sizeHint(self, option, index):
+		size = super().sizeHint(option, index)
+		size.setHeight(max(size.height(), self.rowHeight))
+		return size
+
 ## 树状主视图
 class WizardTreeViewer(QtWidgets.QTreeWidget):
 	viewerTree = None
 	sliderBar = None
 	infoFormat = r" 宏定义: {name:20s}默认值: {default:20s}输入范围: {range:30s}"
+	infoCacheSize = 64		# 最近格式化过的状态栏/帮助信息条数
 
 	def __init__(self, mainWindow, parent=None):
 		super().__init__(parent)
@@ -642,22 +1466,23 @@ class WizardTreeViewer(QtWidgets.QTreeWidget):
 		WizardTreeViewer.viewerTree = self
 		self.root = None
 		# 初始化 TreeView 容器
-		self.setColumnCount(4)
-		self.setColumnHidden(2,True)       # 存放 info
-		self.setColumnHidden(3,True)       # 存放 info
+		self.setColumnCount(2)
 		self.setHeaderLabels(["Option", "Value"])
-		self.setColumnWidth(0, int(mainWindow.width * 0.3))
-		self.setColumnWidth(1, int(mainWindow.width * 0.6)) # 留一部分给边框
 		self.selectionModel().currentChanged.connect(self.onFocusedItemChanged)
 
-		## 样式表
-		boxSize = mainWindow.default_font_size
-		self.setStyleSheet(styleSheet.format(boxSize = boxSize))
-
-		## 初始化递归辅助变量
-		self.curTreeItem = None
+		self.editors = []
+		self.editorWidths = {}		# 宽度比例 -> 像素宽度, 仅在列宽变化时重新计算
+		self.header().sectionResized.connect(self.onSectionResized)
+		self.setColumnWidth(0, int(mainWindow.width * 0.3))
+		self.setColumnWidth(1, int(mainWindow.width * 0.6)) # 留一部分给边框
+		## 状态栏/帮助信息在条目获得焦点时才格式化, 缓存最近的结果
+		self.infoCache = OrderedDict()
 		mainWindow.layout.addWidget(self)
 
+		## 外观由主窗口的调色板与字体决定(加入布局后才继承到字体), 行高由 delegate 统一给出
+		self.setItemDelegate(WizardItemDelegate(self))
+		self.setUniformRowHeights(True)
+
 		# 初始化滑动条
 		self.slider = MySlider()
 		WizardTreeViewer.slider = self.slider
@@ -679,125 +1504,186 @@ class WizardTreeViewer(QtWidgets.QTreeWidget):
 			print("未能读取到 Configuration Wizard Annotations 配置信息")
 			print(f"当前选定文件:{root.description}")
 		else:
-			self.__addItem(root)
+			for node in walkTree(root):
+				self.__addItem(node)
 		self.setExpandAll()
 
+	# 先序遍历保证父条目已建立, 挂到父节点绑定的条目下
 	def __addItem(self, node: ConfigurationNode):
 		if node.identifier == "R":
 			## 初始化根条目
 			self.root = MyTreeWidgetItem(node)
 			self.addTopLevelItem(self.root)
-			self.curTreeItem = self.root
-			node.bindTreeViewItem(self.curTreeItem)
-			self.addHelpInfo(self.root, node)
-			for childItem in node.childNodeTree:
-				self.__addItem(childItem)
-		elif node.identifier == "h":
-			itemChild = MyTreeWidgetItem(node)
-			node.bindTreeViewItem(itemChild)
-			self.addHelpInfo(itemChild, node)
-			self.curTreeItem.addChild(itemChild)
-			# 添加子节点
-			_curNode = self.curTreeItem
-			self.curTreeItem = itemChild
-			for childItem in node.childNodeTree:
-				self.__addItem(childItem)
-			self.curTreeItem = _curNode
-		elif node.identifier == "e" or node.identifier == "c":
-			itemChild = MyTreeWidgetItem(node)
-			
-			itemChild.treeWidget
-			node.bindTreeViewItem(itemChild)
-			self.addHelpInfo(itemChild, node)
-			self.curTreeItem.addChild(itemChild)
+			node.bindTreeViewItem(self.root)
+			return
+		if node.identifier not in ("h", "e", "c", "o", "n", "q", "s", "y"):
+			return
+		itemChild = MyTreeWidgetItem(node)
+		node.bindTreeViewItem(itemChild)
+		node.lastNode.TreeViewItem.addChild(itemChild)
+		if node.identifier == "e" or node.identifier == "c":
 			# 添加复选框
 			widget = MyCheckBox(node, itemChild)
-			self.setItemWidget(itemChild, 1, widget)
-			# 添加子节点
-			_curNode = self.curTreeItem
-			self.curTreeItem = itemChild
-			for childItem in node.childNodeTree:
-				self.__addItem(childItem)
-			self.curTreeItem = _curNode    
+			self.setEditor(itemChild, widget)
 		elif node.identifier == "o":
-			itemChild = MyTreeWidgetItem(node)
-			node.bindTreeViewItem(itemChild)
-			self.curTreeItem.addChild(itemChild)
-			self.addHelpInfo(itemChild, node)
 			widget = None
 			if len(node.comboListValue) != 0:
 				widget = MyComboBox(node)
-			elif node.mask != 0:
+			elif node.mask != 0 and node.mask & (node.mask - 1) == 0:	# 单个位
 				widget = MyCheckBox(node)
-			elif isinstance(node.step, int) and "." not in node.bindingDefineValue:
+			elif isinstance(node.step, int) and "." not in node.getValue():
 				widget = MySpinBox(node)
 			else:
 				widget = MyDoubleSpinBox(node)
 
-			self.setItemWidget(itemChild, 1, widget)
-		elif node.identifier == "n":
-			itemChild = MyTreeWidgetItem(node)
-			node.bindTreeViewItem(itemChild)
-			self.addHelpInfo(itemChild, node)
-			self.curTreeItem.addChild(itemChild)
+			self.setEditor(itemChild, widget)
 		elif node.identifier == "q":
-			itemChild = MyTreeWidgetItem(node)
-			node.bindTreeViewItem(itemChild)
-			self.addHelpInfo(itemChild, node)
-			self.curTreeItem.addChild(itemChild)
 			widget = MyCheckBox(node)
-			self.setItemWidget(itemChild, 1, widget)
+			self.setEditor(itemChild, widget)
 		elif node.identifier == "s":
-			itemChild = MyTreeWidgetItem(node)
-			node.bindTreeViewItem(itemChild)
-			self.addHelpInfo(itemChild, node)
-			self.curTreeItem.addChild(itemChild)
 			widget = MyTextEditer(node)
-			self.setItemWidget(itemChild, 1, widget)
+			self.setEditor(itemChild, widget)
 		elif node.identifier == "y":
-			itemChild = MyTreeWidgetItem(node)
-			node.bindTreeViewItem(itemChild)
-			self.addHelpInfo(itemChild, node)
-			self.curTreeItem.addChild(itemChild)
 			widget = MyTextEditer(node)
-			widget.setFixedWidth(int(self.columnWidth(1)*0.3))
-			self.setItemWidget(itemChild, 1, widget)
-		else:
-			pass
-
-	def addHelpInfo(self, treeItem:MyTreeWidgetItem, node):
+			widget.widthRatio = 0.3
+			self.setEditor(itemChild, widget)
+
+	def helpInfoOf(self, node:ConfigurationNode):
+		cached = self.infoCache.get(node)
+		if cached is not None:
+			self.infoCache.move_to_end(node)
+			return cached
 		if (node.lowerLimit is None) or (node.step is None) or (node.upperLimit is None):
 			_range = "None"
 		else:
 			_range = f"0x{node.lowerLimit:08x} : {node.step} : 0x{node.upperLimit:08x}"
-		treeItem.setData(2,Qt.ItemDataRole.StatusTipRole, WizardTreeViewer.infoFormat.format(name=str(node.bindingDefineName),default=str(node.default),range=_range))
-		if node.helpInfo.__len__ != 0:
-			string = ""
-			for info in node.helpInfo:
-				string = string + info + "\n"
-		treeItem.setData(3,Qt.ItemDataRole.StatusTipRole, string[:-1])  # 不要最后一个换行
-	  
+		info = WizardTreeViewer.infoFormat.format(name=str(node.bindingDefineName),default=str(node.default),range=_range)
+		cached = (info, "\n".join(node.helpInfo))
+		self.infoCache[node] = cached
+		if len(self.infoCache) > WizardTreeViewer.infoCacheSize:
+			self.infoCache.popitem(last=False)
+		return cached
+
 	def onFocusedItemChanged(self, current, previous):
-		info = self.itemFromIndex(current).data(2,Qt.ItemDataRole.StatusTipRole)
-		message = self.itemFromIndex(current).data(3,Qt.ItemDataRole.StatusTipRole)
+		item = self.itemFromIndex(current)
+		if item is None:
+			return
+		node = item.node
+		info, message = self.helpInfoOf(node)
 		self.infoBar.setText(message)
-		self.fatherWindow.statusBar().showMessage(f"{info}")
+		self.fatherWindow.statusBar().showMessage(info)
 		if self.slider.node is not None:
 			self.slider.unbind()
-		if (self.itemFromIndex(current).node.identifier == "o" and self.itemFromIndex(current).node.lowerLimit is not None and self.itemFromIndex(current).node.step is not None):
-			if((self.itemFromIndex(current).node.upperLimit - self.itemFromIndex(current).node.lowerLimit)/self.itemFromIndex(current).node.step < 0x00010000):														
-				self.slider.bindNode(self.itemFromIndex(current).node)				# 过多刻度会使 qt 卡死 而且过大的数字也没必要用滑动条了
-				self.slider.bindSpinbox(self.itemWidget(self.itemFromIndex(current), 1))
+		if (node.identifier == "o" and node.lowerLimit is not None and node.step is not None):
+			if((node.upperLimit - node.lowerLimit)/node.step < 0x00010000):		# 过多刻度会使 qt 卡死 而且过大的数字也没必要用滑动条了
+				self.slider.bindNode(node)
+				self.slider.bindSpinbox(self.itemWidget(item, 1))
 				return
 		self.slider.hide()
 
-	def expandItem(self, item:MyTreeWidgetItem):
-		for i in range(0, item.childCount()):
-			self.expandItem(item.child(i))
+	# 每个选项仍是常驻的编辑控件(setItemWidget), 不经 delegate 按需创建, 构建与 polish 耗时随选项数线性增长
+	def setEditor(self, item:MyTreeWidgetItem, widget):
+		ratio = getattr(widget, "widthRatio", 0.5)
+		if not isinstance(widget, MyCheckBox):
+			widget.setFixedWidth(self.editorWidth(ratio))
+		self.setItemWidget(item, 1, widget)
+		widget.setEnabled(item.node.enable)
+		self.editors.append(widget)
+
+	def editorWidth(self, ratio):
+		width = self.editorWidths.get(ratio)
+		if width is None:
+			width = int(self.columnWidth(1) * ratio)
+			self.editorWidths[ratio] = width
+		return width
+
+	# Value 列宽变化时只调整可见的编辑控件, 只重新布局一次; 折叠的子树在展开时再调整
+	def onSectionResized(self, logicalIndex, oldSize, newSize):
+		if logicalIndex != 1:
+			return
+		self.editorWidths.clear()
+		if self.root is None:
+			return
+		self.setUpdatesEnabled(False)
+		self.fitEditors(self.root.node)
+		self.setUpdatesEnabled(True)
+
+	@staticmethod
+	def isCollapsed(node:ConfigurationNode):
+		return node.TreeViewItem is None or not node.TreeViewItem.isExpanded()
+
+	# 按当前列宽调整 node 下可见(未被折叠)的编辑控件
+	def fitEditors(self, node:ConfigurationNode):
+		for child in walkTree(node, WizardTreeViewer.isCollapsed):
+			widget = self.itemWidget(child.TreeViewItem, 1) if child.TreeViewItem is not None else None
+			if widget is None or isinstance(widget, MyCheckBox):
+				continue
+			width = self.editorWidth(getattr(widget, "widthRatio", 0.5))
+			if widget.maximumWidth() != width:
+				widget.setFixedWidth(width)
+
+	# 批量更新: 期间屏蔽信号并暂停重绘, 结束时统一同步控件、刷新使能状态并只重绘一次
+	@contextmanager
+	def bulkUpdate(self):
+		self.setUpdatesEnabled(False)
+		try:
+			yield
+		finally:
+			self.fatherWindow.wizard.refreshEnable()
+			for widget in self.editors:
+				widget.blockSignals(True)
+				widget.syncFromNode()
+				widget.setEnabled(widget.node.enable)
+				widget.blockSignals(False)
+				if isinstance(widget, MyCheckBox) and widget.treeItem is not None:
+					widget.treeItem.enable = widget.node.enable and widget.node.isSwitchOn()
+					widget.treeItem.setDisabled(not widget.treeItem.enable)
+			self.setExpandAll()
+			self.onFocusedItemChanged(self.currentIndex(), None)
+			self.setUpdatesEnabled(True)
+
+	# values: {节点: 宏值}
+	def applyValues(self, values:dict):
+		with self.bulkUpdate():
+			for node, value in values.items():
+				node.setValue(value)
+
+	def resetToDefault(self):
+		with self.bulkUpdate():
+			self.fatherWindow.wizard.resetToDefault(refresh = False)	# bulkUpdate 结束时统一刷新
+
+	# 分组开关切换: 依赖关系已在解析时建立, 一次遍历只更新受影响的后代
+	def applyEnableState(self, gate:ConfigurationNode):
+		item = gate.TreeViewItem
+		item.enable = gate.enable and gate.isSwitchOn()
+		item.setDisabled(not item.enable)
 		item.setExpanded(item.enable)
+		for node in gate.propagateEnable():
+			widget = self.itemWidget(node.TreeViewItem, 1)
+			if widget is not None:
+				widget.setEnabled(node.enable)
+			if node.identifier == "e" or node.identifier == "c":
+				node.TreeViewItem.enable = node.enable and node.isSwitchOn()
+				node.TreeViewItem.setDisabled(not node.TreeViewItem.enable)
+				node.TreeViewItem.setExpanded(node.TreeViewItem.enable)
+
+	# 禁用的分组不允许展开
+	def expandItem(self, item:MyTreeWidgetItem):
+		if not item.enable:
+			item.setExpanded(False)
+		else:
+			self.fitEditors(item.node)
 
+	# 只处理有子节点的条目, 叶子条目的展开状态无意义
 	def setExpandAll(self):
-		self.expandItem(self.root)
+		if self.root is None:
+			return
+		self.blockSignals(True)
+		for node in walkTree(self.root.node):
+			if len(node.childNodeTree) != 0 and node.TreeViewItem is not None:
+				node.TreeViewItem.setExpanded(node.TreeViewItem.enable)
+		self.blockSignals(False)
+		self.fitEditors(self.root.node)
 
 # 主窗口
 class Configuration_Wizard_GUI(QMainWindow):
@@ -823,10 +1709,8 @@ class Configuration_Wizard_GUI(QMainWindow):
 		self.height = int(app.primaryScreen().size().height() / 1.5)
 		self.default_font_size = int(self.height / 40)
 		Configuration_Wizard_GUI.font_size = self.default_font_size
-		self.default_font = QtGui.QFont(userFont, pointSize=self.default_font_size + 10)
-		# self.default_font.setFamily("Microsoft Yahei UI")
-		self.setStyleSheet(f"font: {self.default_font_size}px; background: 0x404040")
-		self.setFont(self.default_font)
+		self.default_font = None
+		self.applyTheme()
 		self.mainWidget = QWidget()
 		self.setCentralWidget(self.mainWidget)
 		self.layout = QVBoxLayout(self.mainWidget)
@@ -835,13 +1719,45 @@ class Configuration_Wizard_GUI(QMainWindow):
 		self.setWindowTitle("CMSIS Configuration Wizard Annotations GUI")
 		self.setMinimumSize(int(self.default_font_size * 25), int(self.default_font_size * 25))
 		self.resize(self.width, self.height)
-		
+
+		# 先显示窗口, 字体、菜单栏与配置树推迟到首次绘制之后构建
+		self.windowClock = None		# 首次绘制的时间
+		self.startupDone = False
+		self.show()
+
+	def paintEvent(self, event):
+		super().paintEvent(event)
+		if self.windowClock is None:
+			self.windowClock = time.perf_counter()
+			QtCore.QTimer.singleShot(0, self.finishStartup)	# 本次绘制提交之后再做耗时的初始化
+
+	def finishStartup(self):
+		if self.startupDone:
+			return
+		self.startupDone = True
+		self.default_font = QtGui.QFont(userFont)
+		self.default_font.setPixelSize(self.default_font_size)
+		# self.default_font.setFamily("Microsoft Yahei UI")
+		self.setFont(self.default_font)
+
 		# 初始化UI
 		self.set_menuBar()
 		if passinaFile is not None:
 			self.currentFile = passinaFile
 			self.creatTreeView(self.currentFile)
-		self.show()
+		if startupTiming == 1:
+			print(f"窗口显示: {(self.windowClock - launchClock) * 1000:.1f} ms    可交互: {(time.perf_counter() - launchClock) * 1000:.1f} ms")
+
+	# 使用调色板与字体设置外观, 不经过样式表引擎, 子控件直接继承
+	def applyTheme(self):
+		font = self.font()
+		font.setPixelSize(self.default_font_size)
+		self.setFont(font)
+		if len(themePalette) != 0:
+			palette = self.palette()
+			for role, color in themePalette.items():
+				palette.setColor(getattr(QtGui.QPalette.ColorRole, role), QtGui.QColor(color))
+			self.setPalette(palette)
 
 	def set_menuBar(self):
 		# 初始化菜单栏
@@ -870,6 +1786,22 @@ class Configuration_Wizard_GUI(QMainWindow):
 		action.setShortcut("Ctrl+Shift+S")
 		subMenu.addAction(action)
 		subMenu.addSeparator()
+		### 初始化菜单栏->文件->恢复默认值
+		action = QAction("恢复默认值", self)
+		action.triggered.connect(self.resetToDefault)
+		subMenu.addAction(action)
+		subMenu.addSeparator()
+		### 初始化菜单栏->文件->查找宏定义
+		action = QAction("查找宏定义", self)
+		action.triggered.connect(self.findDefine)
+		action.setShortcut("Ctrl+F")
+		subMenu.addAction(action)
+		subMenu.addSeparator()
+		### 初始化菜单栏->文件->比较配置文件
+		action = QAction("比较配置文件", self)
+		action.triggered.connect(self.compareFile)
+		subMenu.addAction(action)
+		subMenu.addSeparator()
 		### 初始化菜单栏->文件->撤销
 		action = QAction("撤销", self)
 		# action.triggered.connect(self.select_file)
@@ -920,6 +1852,57 @@ class Configuration_Wizard_GUI(QMainWindow):
 		self.WizardTreeViewer = WizardTreeViewer(self)
 		self.WizardTreeViewer.creatTreeview(self.root)
 
+	def resetToDefault(self):
+		if self.WizardTreeViewer is None:
+			return
+		self.WizardTreeViewer.resetToDefault()
+
+	# 在当前文件所在目录树内查找宏定义, 名称留空时列出取值冲突的宏定义
+	def findDefine(self):
+		directory = DefineIndex.findRoot(self.currentFile if self.currentFile is not None else os.getcwd())
+		directory = QtWidgets.QFileDialog.getExistingDirectory(self, "选择索引根目录", directory)
+		if directory == "":
+			return
+		name, ok = QtWidgets.QInputDialog.getText(self, "查找宏定义", f"宏名 (留空列出冲突)\n{directory}")
+		if not ok:
+			return
+		index = DefineIndex(directory)
+		index.update()
+		name = name.strip()
+		result = {name: index.find(name)} if name != "" else index.conflicts()
+		lines = []
+		for define, entries in result.items():
+			for relative, line, path, value in entries:
+				lines.append(f"{define}  {relative}:{line}  {path} = {value}")
+		QtWidgets.QMessageBox.information(self, "查找宏定义", "\n".join(lines) if len(lines) != 0 else "未找到")
+
+	# 与另一个配置文件比较, 左右并排列出取值不同的选项
+	def compareFile(self):
+		if self.currentFile is None:
+			return
+		path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "选择比较的配置头文件", os.path.dirname(os.path.abspath(self.currentFile)), "头文件 (*.h);;All files (*)")
+		if path == "":
+			return
+		other = ConfigurationWizard(path)
+		try:
+			other.parseAnnotations()
+		except Exception as e:
+			QtWidgets.QMessageBox.warning(self, "比较配置文件", f"无法解析 {path}\n{e}")
+			return
+		differences = ConfigurationDiff(self.wizard, other).compare()
+		dialog = QtWidgets.QDialog(self)
+		dialog.setWindowTitle(f"比较配置文件 - {len(differences)} 处不同")
+		dialog.resize(int(self.width * 0.8), int(self.height * 0.6))
+		layout = QVBoxLayout(dialog)
+		tree = QtWidgets.QTreeWidget(dialog)
+		tree.setColumnCount(4)
+		tree.setHeaderLabels(["Option", "Define", os.path.basename(self.currentFile), os.path.basename(path)])
+		tree.setUniformRowHeights(True)
+		tree.addTopLevelItems([QtWidgets.QTreeWidgetItem([difference["path"], str(difference["name"]), str(difference["left"]), str(difference["right"])]) for difference in differences])
+		tree.setColumnWidth(0, int(self.width * 0.4))
+		layout.addWidget(tree)
+		dialog.exec()
+
 	def show_about(self):
 		# 初始化内部对话框
 		dialog = QtWidgets.QDialog(self)
@@ -933,9 +1916,99 @@ class Configuration_Wizard_GUI(QMainWindow):
 		if self.currentFile is None:
 			return
 		list = self.wizard.toList()
-		Writer(self.currentFile).writeFile(list)
+		Writer(self.currentFile, self.wizard.encoding).writeFile(list)
+
+# 深层嵌套的合成配置树上测量各遍历的耗时与内存峰值, 以递归遍历作对照
+def benchWalk(depth, breadth = 4, repeat = 5):
+	import tracemalloc
+	lines = ["// <<< Use Configuration Wizard in Context Menu >>>"]
+	for level in range(depth):
+		lines.append(f"// <e> Level {level}")
+		lines.append(f"#define LEVEL_{level} 1")
+		for index in range(breadth):
+			lines.append(f"//   <o> Option {level}.{index} <0-255>")
+			lines.append(f"#define OPTION_{level}_{index} {index}")
+	lines.extend(["// </e>"] * depth)
+	lines.append("// <<< end of configuration section >>>")
+	wizard = ConfigurationWizard(f"<bench depth={depth}>")
+	wizard.parseAnnotations("\n".join(lines).encode("utf-8"))
+	root = wizard.getRoot()
+
+	def recursive(node):
+		count = 1
+		for child in node.childNodeTree:
+			count += recursive(child)
+		return count
+
+	cases = [
+		("recursive", lambda: recursive(root)),
+		("walkTree", lambda: sum(1 for _ in walkTree(root))),
+		("walkTreePost", lambda: sum(1 for _ in walkTreePost(root))),
+		("walkTreeEvents", lambda: sum(1 for _ in walkTreeEvents(root))),
+		("walkTree+prune", lambda: sum(1 for _ in walkTree(root, pruneDisabled))),
+		("hashTree", wizard.hashTree),
+		("toList", lambda: wizard.toList(True)),
+	]
+	print(f"depth={depth} breadth={breadth} nodes={sum(1 for _ in walkTree(root))}")
+	for name, case in cases:
+		try:
+			best = None
+			for _ in range(repeat):
+				start = time.perf_counter()
+				case()
+				elapsed = time.perf_counter() - start
+				best = elapsed if best is None else min(best, elapsed)
+			tracemalloc.start()
+			case()
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+			print(f"{name:16s}{best * 1000:10.2f} ms{peak / 1024:12.1f} KiB")
+		except RecursionError:
+			tracemalloc.stop()
+			print(f"{name:16s}{'RecursionError':>28s}")
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="CMSIS Configuration Wizard Annotations GUI")
+	parser.add_argument("file", nargs="?", help="打开的配置头文件")
+	parser.add_argument("--server", action="store_true", help="以常驻服务模式运行, 通过 stdio 收发 JSON-RPC")
+	parser.add_argument("--timing", action="store_true", help="输出启动耗时(窗口显示/可交互)")
+	parser.add_argument("--index", metavar="DIR", help="建立/更新目录树的宏定义索引, 默认输出冲突的宏定义")
+	parser.add_argument("--find", metavar="NAME", help="配合 --index 查找宏定义所在位置")
+	parser.add_argument("--diff", nargs=2, metavar=("LEFT", "RIGHT"), help="比较两个配置文件(或两个目录内的同名文件), 每个差异输出一行 JSON")
+	parser.add_argument("--bench-walk", type=int, metavar="DEPTH", help="在给定嵌套深度的合成配置树上测量遍历耗时与内存峰值")
+	args = parser.parse_args()
+	if args.bench_walk is not None:
+		benchWalk(args.bench_walk)
+		sys.exit(0)
+	if args.diff is not None:
+		left, right = args.diff
+		if os.path.isdir(left) and os.path.isdir(right):
+			results = ConfigurationDiff.compareDirectories(left, right)
+		else:
+			results = [(left, right) + ConfigurationDiff.tryCompareFiles(left, right)]
+		for leftFile, rightFile, differences, error in results:
+			if error is not None:
+				print(json.dumps({"leftFile": leftFile, "rightFile": rightFile, "error": error}, ensure_ascii=False))
+			for difference in differences:
+				print(json.dumps({"leftFile": leftFile, "rightFile": rightFile, **difference}, ensure_ascii=False))
+		sys.exit(0)
+	if args.index is not None:
+		index = DefineIndex(args.index)
+		index.update()
+		for relative, error in index.errors().items():
+			print(f"解析失败 {relative}: {error}")
+		result = {args.find: index.find(args.find)} if args.find is not None else index.conflicts()
+		for name, entries in result.items():
+			for relative, line, path, value in entries:
+				print(f"{name:24s}{relative}:{line}    {path} = {value}")
+		sys.exit(0)
+	if args.timing:
+		startupTiming = 1
+	if args.server:
+		ConfigurationServer().serve()
+		sys.exit(0)
+	if args.file is not None:
+		passinaFile = args.file
 	app = QApplication(sys.argv)
 	window = Configuration_Wizard_GUI()
 	sys.exit(app.exec())